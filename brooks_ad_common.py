@@ -0,0 +1,581 @@
+"""
+Shared plumbing for the Brooks Glycerin 22 ad image generators
+--------------------------------------------------------------
+test2.py and test3.py differ only in their creative brief, prompt
+requirements and prompt wording. Everything else lives here:
+rate limiting, retries, the on-disk and server-side prompt caches,
+the background writer, resume and the async prompt/image pipeline.
+
+Subclasses set ``creative_brief`` and ``prompt_requirements``, implement
+``_build_static_contents`` and, after calling ``super().__init__``, fill in
+the prompt pieces listed in ``BrooksAdGeneratorBase.__init__``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List
+
+import diskcache
+import httpx
+from PIL import Image
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+from google import genai
+from google.genai import types
+from google.genai import errors as genai_errors
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """True for 429 / 5xx API errors – worth retrying."""
+    return isinstance(exc, genai_errors.APIError) and (exc.code == 429 or exc.code >= 500)
+
+
+def _retry_after_seconds(exc: BaseException) -> float | None:
+    """Server-requested delay from a ``Retry-After`` header, if the error carries one."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+# httpx only speaks HTTP/2 with the optional h2 package; otherwise stay on
+# HTTP/1.1 keep-alive rather than failing at client construction.
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Smallest prefix Gemini accepts for explicit context caching, per model
+_MIN_CACHE_TOKENS = {"gemini-2.5-flash": 1024, "gemini-2.5-pro": 4096}
+
+_backoff = wait_exponential_jitter(initial=1, max=60)
+
+
+def _wait_for_retry(retry_state: RetryCallState) -> float:
+    """Honour ``Retry-After`` when present, else exponential backoff + jitter."""
+    hint = _retry_after_seconds(retry_state.outcome.exception())
+    return min(hint, 60) if hint is not None else _backoff(retry_state)
+
+
+_retry_transient = retry(
+    stop=stop_after_attempt(6),
+    wait=_wait_for_retry,
+    retry=retry_if_exception(_is_transient),
+    reraise=True,
+)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: holds up to ``capacity`` tokens, refilled at
+    ``refill_rate`` tokens per second. Callers only wait when it runs dry."""
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens: float = 1) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.refill_rate)
+            self._last = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+
+class BrooksAdGeneratorBase:
+    """Gemini drafts each image prompt, Imagen 3 renders it; see module docstring."""
+
+    # Returned by generate_image_prompt when Gemini fails outright
+    fallback_prompt = (
+        "High-quality advertising photo of Brooks Glycerin 22 running shoe, "
+        "dynamic composition, dramatic lighting, modern aesthetics"
+    )
+
+    def __init__(
+        self,
+        api_key: str,
+        output_dir: str,
+        concurrency: int = 5,
+        text_rpm: int = 20,
+        image_rpm: int = 20,
+        prompt_batch_size: int = 10,
+        text_model: str = "gemini-2.5-flash",
+    ) -> None:
+        """Init the shared clients, limiters, caches and writer.
+
+        Args:
+            api_key:  Google Gemini API key.
+            output_dir: Directory where images/logs are saved.
+            concurrency: Number of ads (prompt + image) kept in flight at once.
+            text_rpm:  Requests-per-minute quota for the Gemini text model.
+            image_rpm: Requests-per-minute quota for Imagen.
+            prompt_batch_size: Image prompts requested per Gemini call.
+            text_model: Gemini model that drafts the image prompts.
+        """
+        self.api_key = api_key
+        self.output_dir = output_dir
+        self.concurrency = max(1, concurrency)
+        self.prompt_batch_size = max(1, prompt_batch_size)
+
+        # One rate limiter per endpoint, sized to its RPM quota (a zero or
+        # negative quota would never refill and spin the callers forever)
+        text_rpm, image_rpm = max(1, text_rpm), max(1, image_rpm)
+        self._text_bucket = TokenBucket(capacity=text_rpm, refill_rate=text_rpm / 60)
+        self._image_bucket = TokenBucket(capacity=image_rpm, refill_rate=image_rpm / 60)
+
+        # One client for both Imagen 3 and the Gemini prompt crafter. Its pooled
+        # transport (HTTP/2 when h2 is installed) keeps warm connections
+        # shared by all workers.
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                timeout=120_000,  # ms
+                client_args={
+                    "http2": _HTTP2_AVAILABLE,
+                    "limits": httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                },
+            ),
+        )
+        self.text_model_name = text_model
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Single background writer so image saves overlap with API calls.
+        # At most one image (with its record) per worker may wait in the queue,
+        # so pending PNG payloads stay bounded by the concurrency, not the run size.
+        self._write_q: queue.Queue = queue.Queue(maxsize=self.concurrency)
+        # Per-image records are appended as they complete, so a crash keeps them
+        # (the writer thread owns the handle and closes it after each run)
+        self._jsonl_path = os.path.join(output_dir, "generation_log.jsonl")
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+        # Crafted prompts persist across runs, keyed by the exact request
+        self._prompt_cache = diskcache.Cache(os.path.join(output_dir, ".prompt_cache"))
+
+        # Prompt pieces, set by the subclass once its brief is in place:
+        #   _static_contents  – campaign-wide prefix shared by every request
+        #   _prompt_template  – per-image request with a single {n} slot
+        #   _batch_template   – multi-image request with {count} and {labels} slots
+        #   _cache_key_prefix – everything besides the request that shapes a prompt
+        self._static_contents: List = []
+        self._prompt_template = ""
+        self._batch_template = ""
+        self._cache_key_prefix = ""
+
+        # Server-side cache of the static prefix, held only while generate_all_ads runs
+        self._cached_content: str | None = None
+
+    # ------------------------------------------------------------------
+    # PROMPT GENERATION
+    # ------------------------------------------------------------------
+    def _assemble_requirements_block(self) -> str:
+        """Return the numbered requirements block as a single string."""
+        return "\n".join(f"{i + 1}. {req}" for i, req in enumerate(self.prompt_requirements))
+
+    def _build_static_contents(self) -> List:
+        """Campaign-wide prompt prefix – everything except the per-image instruction."""
+        raise NotImplementedError
+
+    def _create_context_cache(self) -> str | None:
+        """Upload the static prompt prefix once as Gemini cached content.
+
+        Returns the cache name, or None when caching isn't available – the
+        prefix is below the model's minimum cacheable size, or the API refused –
+        in which case callers send the full prefix with every request.
+        """
+        try:
+            n_tokens = self.client.models.count_tokens(
+                model=self.text_model_name, contents=self._static_contents
+            ).total_tokens or 0
+            min_tokens = _MIN_CACHE_TOKENS.get(self.text_model_name, 4096)
+            if n_tokens < min_tokens:
+                print(
+                    f"ℹ️  Static prefix is {n_tokens} tokens (< {min_tokens} minimum) – "
+                    "not caching it server-side."
+                )
+                return None
+            cached = self.client.caches.create(
+                model=self.text_model_name,
+                config=types.CreateCachedContentConfig(
+                    contents=self._static_contents,
+                    ttl="3600s",
+                ),
+            )
+            return cached.name
+        except Exception as e:
+            print(f"ℹ️  Context cache unavailable, sending full brief per call: {e}")
+            return None
+
+    def _delete_context_cache(self) -> None:
+        """Drop the server-side cache so it stops accruing storage cost."""
+        name, self._cached_content = self._cached_content, None
+        try:
+            self.client.caches.delete(name=name)
+        except Exception as e:
+            print(f"ℹ️  Could not delete context cache {name}: {e}")
+
+    @_retry_transient
+    def _generate_text(self, request: str, **config):
+        """Rate-limited Gemini text call, retried on 429 / 5xx.
+
+        ``request`` is only the per-call suffix; the static prefix comes from the
+        server-side cache when one exists.
+        """
+        while not self._text_bucket.consume():
+            time.sleep(0.05)
+        if self._cached_content:
+            contents = [request]
+            config["cached_content"] = self._cached_content
+        else:
+            contents = [*self._static_contents, request]
+        return self.client.models.generate_content(
+            model=self.text_model_name,
+            contents=contents,
+            config=types.GenerateContentConfig(**config),
+        )
+
+    def _prompt_cache_key(self, prompt_request: str) -> str:
+        key_material = self._cache_key_prefix + "\n" + prompt_request
+        return hashlib.sha256(key_material.encode()).hexdigest()
+
+    def generate_image_prompt(self, image_number: int) -> str:
+        """Ask Gemini to produce a detailed image prompt.
+
+        Only the short per-image instruction is sent with each call; the brief
+        and requirements block travel as a static prefix (cached server-side
+        when possible), both built once in __init__ – edit
+        self.prompt_requirements before constructing, or subclass.
+        """
+        prompt_request = self._prompt_template.format(n=image_number)
+        key = self._prompt_cache_key(prompt_request)
+        if key in self._prompt_cache:
+            return self._prompt_cache[key]
+
+        try:
+            response = self._generate_text(prompt_request)
+            text = response.text.strip()
+            self._prompt_cache[key] = text
+            return text
+        except Exception as e:
+            print(f"⚠️  Error generating prompt for image {image_number}: {e}")
+            return self.fallback_prompt
+
+    def generate_image_prompt_batch(self, indices: List[int]) -> List[str]:
+        """Craft prompts for several ads with a single Gemini call.
+
+        Cached prompts are reused; the rest are requested as one JSON array.
+        Falls back to one call per image if the reply can't be parsed.
+        """
+        keys = {n: self._prompt_cache_key(self._prompt_template.format(n=n)) for n in indices}
+        prompts = {n: self._prompt_cache[keys[n]] for n in indices if keys[n] in self._prompt_cache}
+        missing = [n for n in indices if n not in prompts]
+
+        if missing:
+            labels = ", ".join(f"#{n}" for n in missing)
+            batch_request = self._batch_template.format(count=len(missing), labels=labels)
+            try:
+                response = self._generate_text(
+                    batch_request,
+                    response_mime_type="application/json",
+                    response_schema=list[str],
+                )
+                batch = json.loads(response.text)
+                if not (isinstance(batch, list) and len(batch) == len(missing)):
+                    raise ValueError(f"expected {len(missing)} prompts, got {batch!r:.80}")
+                for n, text in zip(missing, batch):
+                    prompts[n] = str(text).strip()
+                    self._prompt_cache[keys[n]] = prompts[n]
+            except Exception as e:
+                print(f"⚠️  Batch prompt request failed for images {labels}, falling back: {e}")
+                for n in missing:
+                    prompts[n] = self.generate_image_prompt(n)
+
+        return [prompts[n] for n in indices]
+
+    # ------------------------------------------------------------------
+    # IMAGE GENERATION
+    # ------------------------------------------------------------------
+    @_retry_transient
+    def _generate_images(self, prompt: str):
+        """Rate-limited Imagen call, retried on 429 / 5xx."""
+        while not self._image_bucket.consume():
+            time.sleep(0.05)
+        return self.client.models.generate_images(
+            model="imagen-3.0-generate-002",
+            prompt=prompt,
+            config=types.GenerateImagesConfig(number_of_images=1, aspect_ratio="1:1"),
+        )
+
+    def _image_path(self, image_number: int) -> str:
+        return os.path.join(self.output_dir, f"brooks_glycerin_22_ad_{image_number:02d}.png")
+
+    def _writer_loop(self) -> None:
+        """Drain the write queue on a single background thread.
+
+        Items are ``(image_path, png_bytes, record)``; ``png_bytes`` is None
+        when the ad has no image. The record's ``image_path`` is only filled in
+        once the PNG is safely on disk, and the record is appended to the JSONL
+        log after that. The JSONL handle belongs to this thread alone: it is
+        opened by the first record and closed by a ``None`` item at the end of
+        a run.
+        """
+        jsonl = None
+        while True:
+            item = self._write_q.get()
+            try:
+                if item is None:
+                    if jsonl is not None:
+                        jsonl.close()
+                        jsonl = None
+                    continue
+                filepath, png_bytes, record = item
+                if png_bytes:
+                    try:
+                        # Write aside then rename, so an existing PNG is always
+                        # complete (resume treats any non-empty PNG as done)
+                        tmp_path = filepath + ".tmp"
+                        with open(tmp_path, "wb", buffering=1 << 20) as f:
+                            f.write(png_bytes)
+                        os.replace(tmp_path, filepath)
+                        record["image_path"] = filepath
+                        print(f"  ✓ Saved → {filepath}")
+                    except Exception as e:  # still log the ad, without an image
+                        print(f"⚠️  Error saving {filepath}: {e}")
+                if jsonl is None:
+                    jsonl = open(self._jsonl_path, "a", encoding="utf-8", buffering=1 << 20)
+                jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+                jsonl.flush()
+            except Exception as e:  # keep the single writer alive whatever happens
+                print(f"⚠️  Error logging {self._jsonl_path}: {e}")
+            finally:
+                item = png_bytes = None  # don't pin the last image while blocked on get()
+                self._write_q.task_done()
+
+    def generate_image(self, prompt: str, image_number: int) -> bytes | None:
+        """Render one image with Imagen; return it as PNG bytes, or None on failure."""
+        try:
+            print(f"Generating image {image_number} → {prompt[:90]}…")
+
+            response = self._generate_images(prompt)
+
+            images = getattr(response, "generated_images", None) if response else None
+            image = images[0].image if images else None
+            if image is not None and image.image_bytes:
+                img_bytes = image.image_bytes
+                if image.mime_type not in (None, "image/png"):
+                    # Transcode; PNG bytes are passed on as-is with no decode/re-encode
+                    buf = BytesIO()
+                    Image.open(BytesIO(img_bytes)).save(buf, format="PNG")
+                    img_bytes = buf.getvalue()
+                return img_bytes
+            print("  ⚠️  No images returned")
+            return None
+        except Exception as e:
+            print(f"⚠️  Error generating image {image_number}: {e}")
+            return None
+
+    # ------------------------------------------------------------------
+    # MAIN LOOP
+    # ------------------------------------------------------------------
+    def _one_ad(self, i: int, image_prompt: str) -> Dict:
+        """Render ad #i from its prompt and return its log record.
+
+        ``image_path`` stays None until the writer has saved the PNG, so the
+        record never points at an image that failed to reach disk.
+        """
+        print(f"[{i}] → Calling Imagen 3…")
+        png_bytes = self.generate_image(image_prompt, i)
+        record = {
+            "image_number": i,
+            "prompt": image_prompt,
+            "image_path": None,
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        # Disk I/O happens on the writer thread; don't block the network path
+        self._write_q.put((self._image_path(i), png_bytes, record))
+        print(f"[{i}] ✓ Completed image {i}")
+        return record
+
+    async def generate_all_ads(self, num_images: int = 10) -> List[Dict]:
+        generated_images: List[Dict] = []
+        print("Starting Brooks Glycerin 22 ad image generation…")
+        print(f"Output directory: {self.output_dir}")
+        print(f"Concurrency: {self.concurrency}")
+        print("-" * 60)
+
+        indices = list(range(1, num_images + 1))
+
+        # Resume: ads already on disk cost no prompt or image calls
+        done = self._load_completed(indices)
+        generated_images.extend(done.values())
+        pending = [i for i in indices if i not in done]
+        if done:
+            print(f"Resuming: {len(done)}/{num_images} images already on disk")
+
+        # The first image only waits on a single-prompt call; the remaining
+        # batches are prefetched while it renders.
+        head, rest = pending[:1], pending[1:]
+        chunks = ([head] if head else []) + [
+            rest[start:start + self.prompt_batch_size]
+            for start in range(0, len(rest), self.prompt_batch_size)
+        ]
+
+        # Blocking SDK calls run on a pool owned by this run – enough threads for
+        # both stages at full width – rather than replacing the loop's default one
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=2 * self.concurrency)
+
+        def run_blocking(fn, *args) -> asyncio.Future:
+            return loop.run_in_executor(executor, fn, *args)
+
+        # Stage A crafts prompts, stage B renders them, so a slow Imagen call
+        # never holds up the next prompt batch (and vice versa).
+        prompt_q: asyncio.Queue = asyncio.Queue()
+        prompt_sem = asyncio.Semaphore(self.concurrency)
+
+        async def prompt_worker(chunk: List[int]) -> None:
+            async with prompt_sem:
+                chunk_prompts = await run_blocking(self.generate_image_prompt_batch, chunk)
+            for i, prompt in zip(chunk, chunk_prompts):
+                await prompt_q.put((i, prompt))
+
+        async def prompt_stage() -> None:
+            print(f"Crafting {len(pending)} prompts in {len(chunks)} batch request(s)…")
+            async with asyncio.TaskGroup() as tg:
+                for chunk in chunks:
+                    tg.create_task(prompt_worker(chunk))
+            for _ in range(self.concurrency):
+                await prompt_q.put(None)  # one stop signal per image worker
+
+        async def image_worker() -> None:
+            while (item := await prompt_q.get()) is not None:
+                i, prompt = item
+                generated_images.append(await run_blocking(self._one_ad, i, prompt))
+                print(f"  [{len(generated_images)}/{num_images}] done")
+
+        # The server-side cache only pays off when Gemini will actually be called
+        missing = [
+            i for i in pending
+            if self._prompt_cache_key(self._prompt_template.format(n=i)) not in self._prompt_cache
+        ]
+
+        def teardown() -> None:
+            # Threads already running (e.g. after a stage failed) still use the
+            # context cache and queue records, so they finish before either goes
+            executor.shutdown(wait=True, cancel_futures=True)
+            if self._cached_content:
+                self._delete_context_cache()
+            # every queued image/record is on disk (so image_path is final), and
+            # the log closed, before the summary is written
+            self._write_q.put(None)
+            self._write_q.join()
+
+        try:
+            if missing:
+                self._cached_content = await run_blocking(self._create_context_cache)
+            # A failing stage cancels the others, and the group waits for them
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(prompt_stage())
+                for _ in range(self.concurrency):
+                    tg.create_task(image_worker())
+        except BaseExceptionGroup as group:
+            # Re-raise the first real failure rather than the (nested) group
+            err = group
+            while isinstance(err, BaseExceptionGroup):
+                err = err.exceptions[0]
+            raise err from group
+        finally:
+            # The run's own pool is shutting down, so wait from the loop's default one
+            await asyncio.to_thread(teardown)
+
+        generated_images.sort(key=lambda rec: rec["image_number"])
+        self._save_generation_log(generated_images)
+        print(f"\n✅ Generated {len(generated_images)} ad images!")
+        print(f"📁 Saved in: {self.output_dir}")
+        return generated_images
+
+    # ------------------------------------------------------------------
+    # LOGGING
+    # ------------------------------------------------------------------
+    def _load_completed(self, indices: List[int]) -> Dict[int, Dict]:
+        """Records for ads whose image is already on disk from an earlier run.
+
+        Prompts are recovered from generation_log.jsonl, falling back to the
+        last generation_log.json summary; newer entries win.
+        """
+        logged: Dict[int, Dict] = {}
+
+        def remember(rec) -> None:
+            # Hand-edited or foreign logs may hold anything; keep only real records
+            if isinstance(rec, dict) and isinstance(rec.get("image_number"), int):
+                logged[rec["image_number"]] = rec
+
+        summary_path = os.path.join(self.output_dir, "generation_log.json")
+        try:
+            with open(summary_path, encoding="utf-8") as f:
+                summary = json.load(f)
+            images = summary.get("images") if isinstance(summary, dict) else None
+            for rec in images if isinstance(images, list) else []:
+                remember(rec)
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(self._jsonl_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        remember(json.loads(line))
+                    except ValueError:
+                        continue  # torn last line after a crash
+        except OSError:
+            pass
+
+        done: Dict[int, Dict] = {}
+        for i in indices:
+            filepath = self._image_path(i)
+            if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+                rec = logged.get(i, {})
+                done[i] = {
+                    "image_number": i,
+                    "prompt": rec.get("prompt"),
+                    "image_path": filepath,
+                    "generated_at": rec.get("generated_at"),
+                }
+        return done
+
+    def _save_generation_log(self, images_info: List[Dict]) -> None:
+        log_path = os.path.join(self.output_dir, "generation_log.json")
+        tmp_path = log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "campaign": "Brooks Glycerin 22 Ad Campaign",
+                    "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "total_images": len(images_info),
+                    "images": images_info,
+                },
+                f,
+                indent=2,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, log_path)  # atomic: never leave a half-written log
+        print(f"📋 Log saved → {log_path}")
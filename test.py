@@ -1,7 +1,9 @@
 import google.generativeai as genai
+import functools
+import mimetypes
 import os
+import pathlib
 from dotenv import load_dotenv
-import requests
 
 # Load .env and get the API key
 load_dotenv()
@@ -12,21 +14,27 @@ genai.configure(api_key=google_api_key)
 output_dir = "image/generated_ads"
 os.makedirs(output_dir, exist_ok=True)
 
+# Create the model instance once and reuse it for every call
+_MODEL = genai.GenerativeModel("gemini-2.5-pro")
 
-# Load your image
-with open("/home/ehwkang/DTS_folked/image/Brooks_1.png", "rb") as image_file:
-    image_bytes = image_file.read()
 
-# Create the model instance
-model = genai.GenerativeModel("gemini-2.5-pro")
+@functools.lru_cache(maxsize=None)
+def _load(path):
+    return pathlib.Path(path).read_bytes()
 
-# Send the image as input
-response = model.generate_content([
-    "Describe this image.",
-    {
-        "mime_type": "image/png",
-        "data": image_bytes
-    }
-])
 
-print(response.text)
+def describe_image(path):
+    # Send the image with its real MIME type so the server doesn't have to sniff it
+    mime_type = mimetypes.guess_type(path)[0] or "image/png"
+    response = _MODEL.generate_content([
+        "Describe this image.",
+        {
+            "mime_type": mime_type,
+            "data": _load(path)
+        }
+    ])
+    return response.text
+
+
+if __name__ == "__main__":
+    print(describe_image("/home/ehwkang/DTS_folked/image/Brooks_1.png"))
@@ -1,43 +1,55 @@
-from google import genai
-from google.genai import types
-import google.generativeai as legacy_genai
-from PIL import Image
-from io import BytesIO
+from typing import List
+import asyncio
 import os
-import time
-from typing import List, Dict
-import json
 from dotenv import load_dotenv
 
+from brooks_ad_common import BrooksAdGeneratorBase
+
 # ------------------------------------------------------------
 # Brooks Glycerin 22 Ad Image Generator – Dynamic & Modular
 # ------------------------------------------------------------
 # • No scenario list – Gemini invents each concept.
 # • Prompt requirements are now stored as a list so they can be
 #   easily tweaked, extended, or randomized without touching the
-#   main string. Each call assembles them on‑the‑fly.
+#   main string. They are assembled into a static prompt prefix
+#   that Gemini caches server-side; each call only sends the image #.
+# • Rate limiting, caching, the writer and the async pipeline are
+#   shared with test3.py in brooks_ad_common.py.
 # ------------------------------------------------------------
 
 
-class BrooksAdImageGenerator:
-    def __init__(self, api_key: str, output_dir: str = "brooks_glycerin_22_ads"):
+class BrooksAdImageGenerator(BrooksAdGeneratorBase):
+    def __init__(
+        self,
+        api_key: str,
+        output_dir: str = "brooks_glycerin_22_ads",
+        concurrency: int = 5,
+        text_rpm: int = 20,
+        image_rpm: int = 20,
+        prompt_batch_size: int = 10,
+        text_model: str = "gemini-2.5-flash",
+    ):
         """Init the ad image generator.
 
         Args:
             api_key:  Google Gemini API key.
             output_dir: Directory where images/logs are saved.
+            concurrency: Number of ads (prompt + image) kept in flight at once.
+            text_rpm:  Requests-per-minute quota for the Gemini text model.
+            image_rpm: Requests-per-minute quota for Imagen.
+            prompt_batch_size: Image prompts requested per Gemini call.
+            text_model: Gemini model that drafts the image prompts
+                (Flash by default – prompt drafting doesn't need Pro).
         """
-        self.api_key = api_key
-        self.output_dir = output_dir
-
-        # Image client (Imagen 3)
-        self.client = genai.Client(api_key=api_key)
-
-        # Text client (Gemini‑Pro) for prompt crafting
-        legacy_genai.configure(api_key=api_key)
-        self.text_model = legacy_genai.GenerativeModel("gemini-2.5-pro")
-
-        os.makedirs(output_dir, exist_ok=True)
+        super().__init__(
+            api_key,
+            output_dir,
+            concurrency=concurrency,
+            text_rpm=text_rpm,
+            image_rpm=image_rpm,
+            prompt_batch_size=prompt_batch_size,
+            text_model=text_model,
+        )
 
         # ————————————————————————————————————————————————
         # CREATIVE BRIEF (static, but easy to edit)
@@ -85,117 +97,35 @@ class BrooksAdImageGenerator:
             "Include a short **negative prompt** to avoid rival logos, distorted anatomy, low-poly artefacts, or text errors.",
         ]
 
-    # ------------------------------------------------------------------
-    # PROMPT GENERATION
-    # ------------------------------------------------------------------
-    def _assemble_requirements_block(self) -> str:
-        """Return the numbered requirements block as a single string."""
-        lines = [f"{idx + 1}. {req}" for idx, req in enumerate(self.prompt_requirements)]
-        return "\n".join(lines)
+        # Prompt pieces are built once so every request shares a byte-identical
+        # prefix; the per-image suffix is a template with a single {n} slot.
+        self._requirements_block = self._assemble_requirements_block()
+        self._static_contents = self._build_static_contents()
+        self._prompt_template = """
+        Create a detailed, specific image generation prompt for ad image #{n}.
 
-    def generate_image_prompt(self, image_number: int) -> str:
-        """Ask Gemini to produce a detailed image prompt.
+        Return **only** the image generation prompt with no additional explanation.
+        """
+        self._batch_template = """
+        Create {count} detailed, specific image generation prompts, one each for ad images {labels}.
+        Every prompt must be a distinct concept.
 
-        The requirements block is re‑built each call, so you can modify
-        self.prompt_requirements at runtime or subclass for variations.
+        Return a JSON array of {count} strings – the image generation prompts for ad images
+        {labels}, in that order – with no additional explanation.
         """
-        prompt_request = f"""
+        self._cache_key_prefix = "\n".join([self.text_model_name, *self._static_contents])
+
+    def _build_static_contents(self) -> List:
+        """Campaign-wide prompt prefix: brief first, then requirements."""
+        return [
+            f"""
         Based on this creative brief for Brooks Glycerin 22 running shoes:
 
         {self.creative_brief}
 
-        Create a detailed, specific image generation prompt for ad image #{image_number}.
-        Requirements:\n{self._assemble_requirements_block()}
-
-        Return **only** the image generation prompt with no additional explanation.
+        Every image generation prompt you write must meet these requirements:\n{self._requirements_block}
         """
-
-        try:
-            response = self.text_model.generate_content(prompt_request)
-            return response.text.strip()
-        except Exception as e:
-            print(f"Error generating prompt for image {image_number}: {e}")
-            return (
-                "High‑quality advertising photo of Brooks Glycerin 22 running shoe, "
-                "dynamic composition, dramatic lighting, modern aesthetics"
-            )
-
-    # ------------------------------------------------------------------
-    # IMAGE GENERATION (unchanged)
-    # ------------------------------------------------------------------
-    def generate_image(self, prompt: str, image_number: int) -> str:
-        try:
-            print(f"Generating image {image_number} → {prompt[:90]}…")
-
-            response = self.client.models.generate_images(
-                model="imagen-3.0-generate-002",
-                prompt=prompt,
-                config=types.GenerateImagesConfig(number_of_images=1, aspect_ratio="1:1"),
-            )
-
-            if response and getattr(response, "generated_images", None):
-                filename = f"brooks_glycerin_22_ad_{image_number:02d}.png"
-                filepath = os.path.join(self.output_dir, filename)
-
-                img_bytes = response.generated_images[0].image.image_bytes
-                Image.open(BytesIO(img_bytes)).save(filepath)
-                print(f"  ✓ Saved → {filepath}")
-                return filepath
-            print("  ⚠️ No images returned")
-            return None
-        except Exception as e:
-            print(f"Error generating image {image_number}: {e}")
-            return None
-
-    # ------------------------------------------------------------------
-    # MAIN LOOP
-    # ------------------------------------------------------------------
-    def generate_all_ads(self, num_images: int = 10) -> List[Dict]:
-        generated_images = []
-        print("Starting Brooks Glycerin 22 ad image generation…")
-        print(f"Output directory: {self.output_dir}")
-        print("-" * 60)
-
-        for i in range(1, num_images + 1):
-            print(f"\n[{i}/{num_images}] Crafting prompt…")
-            image_prompt = self.generate_image_prompt(i)
-            print("  → Generating image…")
-            image_path = self.generate_image(image_prompt, i)
-
-            generated_images.append(
-                {
-                    "image_number": i,
-                    "prompt": image_prompt,
-                    "image_path": image_path,
-                    "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
-            time.sleep(3)  # Respect rate limits
-            print(f"  ✓ Completed image {i}")
-
-        self._save_generation_log(generated_images)
-        print(f"\n✅ Generated {len(generated_images)} ad images!")
-        print(f"📁 Saved in: {self.output_dir}")
-        return generated_images
-
-    # ------------------------------------------------------------------
-    # LOGGING
-    # ------------------------------------------------------------------
-    def _save_generation_log(self, images_info: List[Dict]):
-        log_path = os.path.join(self.output_dir, "generation_log.json")
-        with open(log_path, "w", encoding="utf-8") as f:
-            json.dump(
-                {
-                    "campaign": "Brooks Glycerin 22 Ad Campaign",
-                    "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "total_images": len(images_info),
-                    "images": images_info,
-                },
-                f,
-                indent=2,
-                ensure_ascii=False,
-            )
-        print(f"📋 Log saved → {log_path}")
+        ]
 
 
 # ------------------------------------------------------------
@@ -210,13 +140,26 @@ def main():
         return
 
     NUM_IMAGES = int(os.getenv("NUM_AD_IMAGES", "100"))
+    CONCURRENCY = int(os.getenv("CONCURRENCY", "5"))
+    TEXT_RPM = int(os.getenv("TEXT_RPM", "20"))
+    IMAGE_RPM = int(os.getenv("IMAGE_RPM", "20"))
+    PROMPT_BATCH_SIZE = int(os.getenv("PROMPT_BATCH_SIZE", "10"))
+    PROMPT_MODEL = os.getenv("PROMPT_MODEL", "gemini-2.5-flash")
 
-    gen = BrooksAdImageGenerator(api_key=API_KEY, output_dir="brooks_glycerin_22_campaign")
+    gen = BrooksAdImageGenerator(
+        api_key=API_KEY,
+        output_dir="brooks_glycerin_22_campaign",
+        concurrency=CONCURRENCY,
+        text_rpm=TEXT_RPM,
+        image_rpm=IMAGE_RPM,
+        prompt_batch_size=PROMPT_BATCH_SIZE,
+        text_model=PROMPT_MODEL,
+    )
 
 
 
     try:
-        gen.generate_all_ads(num_images=NUM_IMAGES)
+        asyncio.run(gen.generate_all_ads(num_images=NUM_IMAGES))
     except Exception as e:
         print(f"Fatal error: {e}\nCheck your API key and internet connection.")
 
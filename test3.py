@@ -5,7 +5,10 @@ This script auto-generates ad-ready prompts for Imagen 3 via Gemini Pro/Flash.
 It now
 • uses a richer, production-grade prompt requirements list,
 • lets Gemini "see" reference mock-ups so it can mimic branding/typography,
+• uploads the brief, references and requirements once as Gemini cached content,
 • keeps the original CLI + logging workflow intact.
+Rate limiting, caching, the writer and the async pipeline are shared with
+test2.py in brooks_ad_common.py.
 
 Usage (TL;DR)
 --------------
@@ -13,12 +16,16 @@ Usage (TL;DR)
    preferred overlay style in the same folder or anywhere you like.
    In this example we name them `beach_mock.png` and `bench_mock.png`.
 2. Create a `.env` file next to this script containing your GOOGLE_API_KEY and
-   optional NUM_AD_IMAGES, e.g.:
+   optional NUM_AD_IMAGES / CONCURRENCY / TEXT_RPM / IMAGE_RPM /
+   PROMPT_BATCH_SIZE (set USE_GEMINI_FLASH=0 to draft prompts with Pro), e.g.:
 
      GOOGLE_API_KEY="YOUR-KEY-HERE"
      NUM_AD_IMAGES=5
+     CONCURRENCY=5
 
 3. Run:  `python brooks_ad_image_generator.py`
+   (Optional: `pip install "httpx[http2]"` lets API calls share HTTP/2
+   connections; without it the client falls back to HTTP/1.1 keep-alive.)
 
 Gemini will craft a fresh prompt for each image while respecting your visual
 guidelines; Imagen 3 then turns each prompt into a 1×1 image and saves them in
@@ -27,50 +34,65 @@ guidelines; Imagen 3 then turns each prompt into a 1×1 image and saves them in
 
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import mimetypes
 import os
-import time
-import json
-from io import BytesIO
-from typing import List, Dict
+from typing import List
 
 from dotenv import load_dotenv
-from PIL import Image
 
-# Gemini SDKs
-from google import genai  # Imagen 3 & Files API
-from google.genai import types  # Helper for Imagen config
-import google.generativeai as legacy_genai  # Gemini-Pro/Flash text model
+from google.genai import types  # Gemini request parts
 
+from brooks_ad_common import BrooksAdGeneratorBase
 
-class BrooksAdImageGenerator:
+
+class BrooksAdImageGenerator(BrooksAdGeneratorBase):
     """Generate Brooks Glycerin 22 ad images using Gemini + Imagen 3."""
 
+    fallback_prompt = (
+        "High-quality ad photo of Brooks Glycerin 22 shoe with modern brand overlay, "
+        "bold tagline, and energetic atmosphere."
+    )
+
     def __init__(
         self,
         api_key: str,
         output_dir: str = "brooks_glycerin_22_ads",
         reference_image_paths: List[str] | None = None,
-        use_flash: bool = False,
+        use_flash: bool = True,
+        concurrency: int = 5,
+        text_rpm: int = 20,
+        image_rpm: int = 20,
+        prompt_batch_size: int = 10,
     ) -> None:
-        self.api_key = api_key
-        self.output_dir = output_dir
-        os.makedirs(output_dir, exist_ok=True)
+        super().__init__(
+            api_key,
+            output_dir,
+            concurrency=concurrency,
+            text_rpm=text_rpm,
+            image_rpm=image_rpm,
+            prompt_batch_size=prompt_batch_size,
+            text_model="gemini-2.5-flash" if use_flash else "gemini-2.5-pro",
+        )
 
-        self.reference_images: List[Image.Image] = []
+        # Raw bytes + MIME go to Gemini as-is – no PIL decode/re-encode per call
+        self.reference_parts: List[types.Part] = []
+        reference_hash = hashlib.sha256()
         if reference_image_paths:
             for path in reference_image_paths:
                 try:
-                    self.reference_images.append(Image.open(path))
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    mime_type = mimetypes.guess_type(path)[0] or "image/png"
+                    self.reference_parts.append(types.Part.from_bytes(data=data, mime_type=mime_type))
+                    reference_hash.update(data)
                 except Exception as e:
                     print(f"⚠️  Could not load reference image '{path}': {e}")
-        if not self.reference_images:
+        self._reference_digest = reference_hash.hexdigest()
+        if not self.reference_parts:
             print("ℹ️  No reference images loaded – prompts will be text-only.")
 
-        self.client = genai.Client(api_key=api_key)
-        legacy_genai.configure(api_key=api_key)
-        model_name = "gemini-2.5-flash" if use_flash else "gemini-2.5-pro"
-        self.text_model = legacy_genai.GenerativeModel(model_name)
-
         self.creative_brief = (
             """
             Brooks Glycerin 22 Creative Brief:\n\n"
@@ -109,10 +131,30 @@ class BrooksAdImageGenerator:
             "Include a short **negative prompt** to avoid rival logos, distorted anatomy, low-poly artefacts, or text errors.",
         ]
 
-    def _assemble_requirements_block(self) -> str:
-        return "\n".join(f"{i + 1}. {req}" for i, req in enumerate(self.prompt_requirements))
+        self._requirements_block = self._assemble_requirements_block()
+        # Prompt pieces are built once so every request shares a byte-identical prefix
+        self._static_contents = self._build_static_contents()
+        self._prompt_template = """
+Now create a detailed, specific image-generation prompt for ad image #{n}.
+
+Return **only** the image prompt — no extra commentary.
+"""
+        self._batch_template = """
+Now create {count} detailed, specific image-generation prompts, one each for ad images {labels}.
+Every prompt must be a distinct concept.
 
-    def generate_image_prompt(self, image_number: int) -> str:
+Return a JSON array of {count} strings – the image prompts for ad images {labels},
+in that order – no extra commentary.
+"""
+        # Identical model + references + request → reuse the prompt from a previous run
+        static_text = [c for c in self._static_contents if isinstance(c, str)]
+        self._cache_key_prefix = "\n".join(
+            [self.text_model_name, self._reference_digest, *static_text]
+        )
+
+    def _build_static_contents(self) -> List:
+        """Campaign-wide prompt prefix: reference images, brief, layout notes
+        and requirements – everything except the per-image instruction."""
         visual_instruction = """
 The reference images shown above are **only** for layout style. 
 Use them to understand:
@@ -125,101 +167,16 @@ Only apply the same **typographic overlay approach** when composing the visual p
 Make sure you position the brand name and tagline, but in a way that fits the new scene you create.
 """
 
-        prompt_request = f"""
+        static_request = f"""
 Based on this creative brief for Brooks Glycerin 22 running shoes:
 {self.creative_brief}
 
 {visual_instruction}
 
-Now create a detailed, specific image-generation prompt for ad image #{image_number}.
-
-Requirements:
-{self._assemble_requirements_block()}
-
-Return **only** the image prompt — no extra commentary.
+Requirements for every image-generation prompt you write:
+{self._requirements_block}
 """
-
-        contents = self.reference_images + [prompt_request]
-
-        try:
-            response = self.text_model.generate_content(contents=contents)
-            return response.text.strip()
-        except Exception as e:
-            print(f"⚠️  Error generating prompt for image {image_number}: {e}")
-            return (
-                "High-quality ad photo of Brooks Glycerin 22 shoe with modern brand overlay, bold tagline, and energetic atmosphere."
-            )
-
-    def generate_image(self, prompt: str, image_number: int) -> str | None:
-        try:
-            print(f"  ↳  Generating image {image_number} → {prompt[:80]}…")
-
-            response = self.client.models.generate_images(
-                model="imagen-3.0-generate-002",
-                prompt=prompt,
-                config=types.GenerateImagesConfig(number_of_images=1, aspect_ratio="1:1"),
-            )
-
-            if response and getattr(response, "generated_images", None):
-                filename = f"brooks_glycerin_22_ad_{image_number:02d}.png"
-                filepath = os.path.join(self.output_dir, filename)
-
-                img_bytes = response.generated_images[0].image.image_bytes
-                Image.open(BytesIO(img_bytes)).save(filepath)
-                print(f"  ✓ Saved → {filepath}")
-                return filepath
-
-            print("  ⚠️  No images returned (empty response)")
-            return None
-        except Exception as e:
-            print(f"⚠️  Error generating image {image_number}: {e}")
-            return None
-
-    def generate_all_ads(self, num_images: int = 10) -> List[Dict]:
-        generated_images: List[Dict] = []
-
-        print("Starting Brooks Glycerin 22 ad image generation…")
-        print(f"Output directory: {self.output_dir}")
-        print("-" * 60)
-
-        for i in range(1, num_images + 1):
-            print(f"\n[{i}/{num_images}] Crafting prompt…")
-            image_prompt = self.generate_image_prompt(i)
-            print("  → Calling Imagen 3…")
-            image_path = self.generate_image(image_prompt, i)
-
-            generated_images.append(
-                {
-                    "image_number": i,
-                    "prompt": image_prompt,
-                    "image_path": image_path,
-                    "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
-
-            time.sleep(3)
-            print(f"✓ Completed image {i}")
-
-        self._save_generation_log(generated_images)
-        print(f"\n✅ Generated {len(generated_images)} ad images!")
-        print(f"📁  Saved in: {self.output_dir}")
-        return generated_images
-
-    def _save_generation_log(self, images_info: List[Dict]) -> None:
-        log_path = os.path.join(self.output_dir, "generation_log.json")
-        with open(log_path, "w", encoding="utf-8") as f:
-            json.dump(
-                {
-                    "campaign": "Brooks Glycerin 22 Ad Campaign",
-                    "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "total_images": len(images_info),
-                    "images": images_info,
-                },
-                f,
-                indent=2,
-                ensure_ascii=False,
-            )
-        print(f"📋 Log saved → {log_path}")
+        return [*self.reference_parts, static_request]
 
 
 def main() -> None:
@@ -240,11 +197,15 @@ def main() -> None:
         api_key=api_key,
         output_dir="brooks_glycerin_22_campaign",
         reference_image_paths=reference_paths,
-        use_flash=bool(os.getenv("USE_GEMINI_FLASH")),
+        use_flash=os.getenv("USE_GEMINI_FLASH", "1").lower() not in ("0", "false", "no"),
+        concurrency=int(os.getenv("CONCURRENCY", "5")),
+        text_rpm=int(os.getenv("TEXT_RPM", "20")),
+        image_rpm=int(os.getenv("IMAGE_RPM", "20")),
+        prompt_batch_size=int(os.getenv("PROMPT_BATCH_SIZE", "10")),
     )
 
     try:
-        gen.generate_all_ads(num_images=num_images)
+        asyncio.run(gen.generate_all_ads(num_images=num_images))
     except Exception as e:
         print(f"Fatal error: {e}\nCheck your API key, file paths, and internet connection.")
 